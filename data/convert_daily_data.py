@@ -1,7 +1,19 @@
+import csv
+import itertools
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import scipy.io as io
 
+try:
+    from numba import njit
+except ImportError:
+    # fall back to plain Python if numba is not installed
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 #----------------------------------------------------------------------
 # The following script loads the S&P 500 and Fama-French data
 # for the Stat240 final project, matches them by date, and
@@ -12,60 +24,88 @@ def prices_to_returns(p):
     """
     Convert prices to returns.
     """
-    p = np.asarray(p)
-    p = p.astype(float)
-    m = len(p)
-    r = np.zeros((m-1,1))
-    for i in xrange(m-1):
-        r[i] = (p[i+1]-p[i])/p[i]
-    return r
+    p = np.asarray(p, dtype=float).ravel()
+    return (p[1:] - p[:-1]) / p[:-1]
+
+# function to load numeric csv and txt data
+def _load_numeric(path, sep=None, skiprows=0):
+    """
+    Parse a purely numeric text file directly into a 2-D float array.
+    """
+    return np.loadtxt(path, delimiter=sep, skiprows=skiprows, dtype=float, ndmin=2)
 
-# function to load csv and txt data
 def load_text(csvfile, sep=",", num_headerlines=0, header_return=None):
     """
-    Load data from text files, skipping num_headerlines and returning the 
-    header_return line as a separate output.
+    Load data from purely numeric text files, skipping num_headerlines and 
+    returning the header_return line as a separate output. The data are 
+    returned as a 2-D float ndarray rather than a list of string rows; 
+    Yahoo! Finance price files are read with load_yahoo instead.
     """
-    loaded_csv = open(csvfile, 'r')
-    out = []
-    for row in loaded_csv:
-        if sep is not None:
-            out.append(row.strip().split(sep))
-        else:
-            out.append(row.strip().split())
     if header_return is not None:
-        header = out[header_return]
+        with open(csvfile, 'r', newline='') as loaded_csv:
+            if sep is not None:
+                reader = csv.reader(loaded_csv, delimiter=sep)
+            else:
+                # whitespace separated: skipinitialspace collapses runs of spaces
+                reader = csv.reader((row.strip() for row in loaded_csv),
+                                    delimiter=' ', skipinitialspace=True)
+            header = next(itertools.islice(reader, header_return, None))
     else:
         header = False
-    out = out[num_headerlines:] # strip header
+    out = _load_numeric(csvfile, sep=sep, skiprows=num_headerlines)
     return header, out
 
-def get_dates_yahoo(yahoo_list,order="chronological"):
+# column layout of Yahoo! Finance price files; dates are quoted
+# ("YYYY-MM-DD"), hence 12 characters
+YAHOO_DTYPE = [('date','U12'), ('open',float), ('high',float), ('low',float),
+               ('close',float), ('volume',float), ('adj_close',float)]
+
+def load_yahoo(yahoo_path, sep="\t"):
+    """
+    Load a Yahoo! Finance price file as a structured array with one 
+    typed column per field, so prices are parsed straight to floats.
     """
-    Get data information from yahoo finance data,
-    removing the hyphens and tabs. Order specifies 
-    whether the data and returns are given in chronological
+    return np.genfromtxt(yahoo_path, delimiter=sep, skip_header=1,
+                         dtype=YAHOO_DTYPE, encoding='utf-8')
+
+def get_dates_yahoo(yahoo_data,order="chronological"):
+    """
+    Get data information from yahoo finance data as YYYYMMDD
+    integers, removing the hyphens and quotes. Order specifies 
+    whether the data and prices are given in chronological
     or reverse order.
     """
-    list_of_lists = [item[0].split("\t") for item in yahoo_list]
-    dates = [item[0] for item in list_of_lists]
-    returns = [item[4] for item in list_of_lists]
-    yahoo_dates = []
-    for yd in dates:
-        yd_all = yd.split('-')
-        whole = ''
-        for part in yd_all:
-            whole += part
-        yahoo_dates.append(whole[1:9])
+    yahoo_dates = np.char.strip(np.char.replace(yahoo_data['date'], '-', ''), '"').astype(np.int64)
+    yahoo_prices = yahoo_data['close']
     if order == "chronological":
-        yahoo_dates = yahoo_dates[::-1]
-        yahoo_returns = returns[::-1]
-        return yahoo_dates, yahoo_returns
+        return yahoo_dates[::-1], yahoo_prices[::-1]
     elif order == "reverse":
-        return yahoo_dates, yahoo_returns
+        return yahoo_dates, yahoo_prices
     else:
         raise ValueError("'order' value is incorrect")
 
+@njit(cache=True)
+def _match_sorted(daily_dates, daily_returns, target_dates):
+    """
+    Two-pointer merge of sorted integer dates. For each target date, find
+    the closest previous (or equal) daily date that has a return, emit
+    that date and its return, and flag the target as missed if the 
+    dates are not equal.
+    """
+    n = min(len(daily_dates), len(daily_returns))
+    m = len(target_dates)
+    matched_dates = np.empty(m, dtype=np.int64)
+    matched_returns = np.empty(m, dtype=np.float64)
+    missed = np.empty(m, dtype=np.bool_)
+    j = 0
+    for i in range(m):
+        while j+1 < n and daily_dates[j+1] <= target_dates[i]:
+            j += 1
+        matched_dates[i] = daily_dates[j]
+        matched_returns[i] = daily_returns[j]
+        missed[i] = daily_dates[j] != target_dates[i]
+    return matched_dates, matched_returns, missed
+
 def match_data(daily_dates, daily_returns, target_dates):
     """
     Given a set of target dates and a set of daily dates (from returns), 
@@ -75,111 +115,133 @@ def match_data(daily_dates, daily_returns, target_dates):
     return how many of the days are inexact in 'misses', and return 
     the date matched daily returns. 
     """
-    # Get indices of daily Libor returns that appear in Fama-French data
-    daily_indices = [idx for idx, dd in zip(range(len(daily_dates)), daily_dates) if dd in target_dates]
-    daily_matched_returns = np.zeros(len(daily_indices),)
-    daily_matched_dates = np.array(daily_dates)[daily_indices]
-    matches = [item for item in daily_matched_dates if item in target_dates]
-    misses = [item for item in target_dates if item not in matches]
-
-    # Find and replace missing dates with the previous date's data
-    j = 0
-    daily_matched_dates = daily_matched_returns.copy()
-    for i in xrange(len(target_dates)):
-        if target_dates[i] not in misses:
-            daily_matched_returns[i] = daily_returns[daily_indices[j]]
-            daily_matched_dates[i] = daily_dates[daily_indices[j]]
-            j += 1
-        else:
-            daily_matched_returns[i] = daily_returns[daily_indices[j]]
-            daily_matched_dates[i] = daily_dates[daily_indices[j]]
+    # Dates are chronological YYYYMMDD integers, so walk both sorted
+    # arrays once
+    daily_dates_arr = np.asarray(daily_dates, dtype=np.int64)
+    target_dates_arr = np.asarray(target_dates, dtype=np.int64)
+    daily_matched_dates, daily_matched_returns, missed = _match_sorted(
+        daily_dates_arr, np.asarray(daily_returns, dtype=float), target_dates_arr)
+
+    misses = target_dates_arr[missed].tolist()
     return misses, daily_matched_dates, daily_matched_returns
 
+def _process_one(input_tuple, target_path, target_dates, RF_scaled=None):
+    """
+    Load, match, and save a single (input_path, output_type) input against
+    the target dates. RF_scaled is the monthly risk free rate matched to the
+    target, required for "premiums" outputs. Returns the input path, its
+    matched data, and the progress messages, which are printed by the 
+    caller so output from parallel workers does not interleave.
+    """
+    messages = []
+    def log(*args):
+        messages.append(" ".join(str(arg) for arg in args))
+
+    # get path and output type
+    input_path = input_tuple[0]
+    output_type = input_tuple[1]
+
+    # load the input data, assuming standard Yahoo! Finance header
+    input_data = load_yahoo(input_path)
+    log("Matching data from", input_path)
+
+    # Get dates for input
+    log("\t--> Getting dates...")
+    input_dates, input_data = get_dates_yahoo(input_data)
+
+    # Set output type
+    if output_type in ("returns", "premiums"):
+        log("\t--> Converting", input_path, "to returns.")
+        input_data = prices_to_returns(input_data)
+    else:
+        log("\t--> Returning prices for", input_path)
+
+    # Match input to target dates and get matched returns
+    log("\t--> Matching to target...")
+    missed_target_dates, matched_input_dates, matched_input_data = match_data(input_dates, input_data, target_dates)
+    if missed_target_dates != []:
+        log("\t--> Number of missed target dates in", target_path, "by", input_path, ":", missed_target_dates)
+        log("\t--> Replacing with data from closest previous date.")
+        
+    # If output_type is premiums, convert to premiums using matched Libor data
+    if output_type=="premiums" and RF_scaled is not None:
+        log("\t--> Converting", input_path, "to premiums.")
+
+        # subtract risk_free asset in place; matched data is a fresh 1-D float array
+        matched_input_data = np.ascontiguousarray(matched_input_data, dtype=float).ravel()
+        np.subtract(matched_input_data, RF_scaled, out=matched_input_data)
+
+    # Save matched returns
+    outpath = os.path.join(os.path.abspath('.'),output_type)
+    outfile = os.path.join(outpath,input_path.split('/')[-1].split('.')[0]+'_returns.csv') # danger, input path should have just one '.'
+    log("\t--> Saving matched data as", outfile)
+    np.savetxt(outfile, matched_input_data, delimiter=",", fmt="%.8g")
+    np.save(os.path.splitext(outfile)[0]+'.npy', matched_input_data) # binary copy for fast reloads
+
+    return input_path, matched_input_data, messages
+
 def match_dates_and_save(input_list, target_path, order="chronological", 
-                         save_mat=True, input_sep=",", target_sep=None, risk_free_path=None): 
+                         save_mat=True, input_sep=",", target_sep=None, risk_free_path=None,
+                         dtype=np.float64): 
     """
     Main parsing function. Combines other functions in this file to load data, 
     match daily price dates to target dates, convert to returns, and save the data. 
 
-    It iterates over a list of input files, and can output a .MAT file whose columns are
+    It processes a list of input files in parallel, and can output a .MAT file whose columns are
     the matched returns for the inputs in the list.
 
     If output_type is "premiums", the path to a risk free asset must be specifed in 
-    risk_free_path. This should be of the same format as the input file, but already
-    matched to the target.
+    risk_free_path. This should be a numeric file with one value per target date,
+    already matched to the target.
+
+    input_sep is the separator of the risk free file only; the Yahoo! Finance inputs
+    are always read as tab separated by load_yahoo.
+
+    The predictors and targets in the .MAT file are stored as dtype, float64 by
+    default since glmnet in OneStepPrediction.m only accepts double matrices;
+    pass dtype=np.float32 for a smaller file when double is not needed.
     """
     # make sure input list is a list
-    if type(input_list) != type([]):
+    if not isinstance(input_list, list):
         input_list = [input_list]
 
     # initialize containers
     if save_mat:
-        out_mat = None
+        collected = []
 
     # load the target data -- NOTE: headers are particular to Fama-French data!
-    print "\t--> Loading target data..."
+    print("\t--> Loading target data...")
     target_header, target_data = load_text(target_path, sep=target_sep, num_headerlines=3, header_return=1)
 
+    # Get target dates once; they are shared by every input
+    target_dates = target_data[:,0].astype(np.int64)
+
     # Convert target data to premiums, loading and subtracting risk_free asset
+    RF_scaled = None
     if risk_free_path is not None:
         RF_header, RF_data = load_text(risk_free_path, sep=input_sep, num_headerlines=0, header_return=None) 
+        RF_scaled = (1./(12*100.))*np.ravel(RF_data)
         target_indices = [1,4,7,10,13,16]
-        target_data_out = (np.array(target_data).astype(float) - (1./(12*100.))*np.asarray(RF_data).astype(float))[:,target_indices]
-
-    # loop over input paths
-    for input_tuple in input_list:
-        # get path and output type
-        input_path = input_tuple[0]
-        output_type = input_tuple[1]
-
-        # load the input data, assuming standard Yahoo! Finance header
-        input_header, input_data = load_text(input_path, sep=input_sep, num_headerlines=1, header_return=0) 
-        print "Matching data from", input_path
-
-        # Get dates for input
-        print "\t--> Getting dates..."
-        input_dates, input_data = get_dates_yahoo(input_data)
-
-        # Get target dates
-        target_dates = [td[0] for td in target_data]
-
-        # Set output type
-        if output_type is "returns" or "premiums":
-            print "\t--> Converting", input_path, "to returns."
-            input_data = prices_to_returns(input_data)
-        else:
-            print "\t--> Returning prices for", input_path
-
-        # Match input to target dates and get matched returns
-        print "\t--> Matching to target..."
-        missed_target_dates, matched_input_dates, matched_input_data = match_data(input_dates, input_data, target_dates)
-        if missed_target_dates != []:
-            print "\t--> Number of missed target dates in", target_path, "by", input_path, ":", missed_target_dates
-            print "\t--> Replacing with data from closest previous date."
-            
-        # If output_type is premiums, convert to premiums using matched Libor data
-        if output_type=="premiums" and risk_free_path is not None:
-            print "\t--> Converting", input_path, "to premiums."
-
-            # load and subtract risk_free asset
-            matched_input_data = matched_input_data - (1./(12*100.))*np.squeeze(np.asarray(RF_data).astype(float))
-
-        # Save matched returns
-        outpath = os.path.join(os.path.abspath('.'),output_type)
-        outfile = os.path.join(outpath,input_path.split('/')[-1].split('.')[0]+'_returns.csv') # danger, input path should have just one '.'
-        print "\t--> Saving matched data as", outfile
-        np.savetxt(outfile, matched_input_data, delimiter=",")
-
-        if save_mat:
-            if out_mat is None:
-                out_mat = np.array(matched_input_data)
-            else:
-                out_mat = np.vstack((out_mat, np.array(matched_input_data)))
+        target_data_out = (target_data - RF_scaled[:,None])[:,target_indices]
+
+    # process the input files in parallel; each is independent of the others
+    max_workers = max(1, min(len(input_list), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_process_one, input_tuple, target_path, target_dates, RF_scaled)
+                   for input_tuple in input_list]
+        for future in futures:
+            input_path, matched_input_data, messages = future.result()
+            print("\n".join(messages))
+            if save_mat:
+                collected.append(np.ravel(matched_input_data))
 
     if save_mat:
         mat_outpath = os.path.join(os.path.abspath('.'),'matfiles/')
-        out_dict = {'predictors':out_mat.T, 'targets':target_data_out}
-        io.savemat(mat_outpath+'All_variables_matched.mat', out_dict)
+        out_mat = np.stack(collected, axis=0)
+        out_dict = {'predictors':out_mat.T.astype(dtype, copy=False),
+                    'targets':target_data_out.astype(dtype, copy=False)}
+        # format and compression spelled out explicitly; these are scipy's defaults
+        io.savemat(mat_outpath+'All_variables_matched.mat', out_dict, format='5', do_compression=False)
 
 if __name__ == '__main__':
     input_list = [('./raw/GoldSilver.csv','returns'),('./raw/Nasdaq.csv','returns'), ('./raw/NYSE_Composite.csv','returns'), ('./raw/Treasury10yr.csv','prices'), ('./raw/Treasury_5year.csv','prices'), ('./raw/VIX.csv','returns'), ('./raw/SP500_Revised.csv','premiums')]